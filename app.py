@@ -9,23 +9,28 @@ import os
 import re
 import secrets
 import smtplib
+import threading
 import time
 from collections import defaultdict
+from functools import lru_cache
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from dotenv import load_dotenv
 load_dotenv()
 from datetime import timedelta, datetime
 from pathlib import Path
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Depends, Header, BackgroundTasks, Request
-from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Depends, Header, BackgroundTasks, Body, Request
+from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from typing import Optional
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 import bcrypt as _bcrypt
 import psycopg2
+from psycopg2 import pool as _pg_pool
 from psycopg2.extras import DictCursor
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
 from botocore.exceptions import ClientError
 
@@ -94,10 +99,46 @@ DATABASE_URL = os.environ.get("DATABASE_URL", "")
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
+# Пул соединений: psycopg2.connect на каждый запрос — это TCP + TLS + аутентификация,
+# под нагрузкой это доминирует. Держим готовые соединения и переиспользуем их.
+_DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+_DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "8"))
+_db_pool = None
+
+# getconn() у ThreadedConnectionPool не умеет ждать — при разобранном пуле он
+# сразу кидает PoolError. Семафор заставляет лишние обработчики подождать
+# свободное соединение вместо 500-й ошибки.
+_db_pool_slots = threading.BoundedSemaphore(_DB_POOL_MAX)
+
+
+def _get_db_pool():
+    global _db_pool
+    if _db_pool is None:
+        if not DATABASE_URL:
+            raise RuntimeError("DATABASE_URL не задан в переменных окружения")
+        # synchronous_commit=off — аналог sqlite "synchronous=NORMAL": коммит не ждёт
+        # fsync WAL на диске. При падении сервера теряются последние доли секунды
+        # коммитов, но целостность БД не страдает. Настройки задаются один раз
+        # на физическое соединение (startup packet), а не на каждый запрос.
+        _db_pool = _pg_pool.ThreadedConnectionPool(
+            _DB_POOL_MIN, _DB_POOL_MAX, DATABASE_URL,
+            options="-c synchronous_commit=off",
+            keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+        )
+    return _db_pool
+
 # === Настройка Cloudflare R2 ===
 R2_BUCKET = os.environ.get("R2_BUCKET", "")
 _r2_client = None
 
+# Загрузка потоково, чанками по 8 МБ и без пула потоков boto3:
+# обработчики и так выполняются в threadpool, лишние 10 потоков на файл не нужны
+_R2_TRANSFER = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    use_threads=False,
+)
+
 
 def get_r2():
     global _r2_client
@@ -122,7 +163,11 @@ def get_r2():
 
 
 class DBConnection:
-    """Обёртка над psycopg2: интерфейс conn.execute(...) → cursor с fetch* и dict-доступом."""
+    """Обёртка над psycopg2: интерфейс conn.execute(...) → cursor с fetch* и dict-доступом.
+
+    Соединение берётся из пула и возвращается туда при выходе из контекста
+    (сломанные соединения закрываются, а не возвращаются).
+    """
 
     def __init__(self, conn):
         self._conn = conn
@@ -135,24 +180,42 @@ class DBConnection:
             cur.execute(query, params)
         return cur
 
+    def executemany(self, query, param_seq):
+        cur = self._conn.cursor(cursor_factory=DictCursor)
+        cur.executemany(query, param_seq)
+        return cur
+
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        broken = False
         try:
             if exc_type is None:
                 self._conn.commit()
             else:
                 self._conn.rollback()
+        except psycopg2.Error:
+            broken = True
+            raise
         finally:
-            self._conn.close()
+            try:
+                _get_db_pool().putconn(self._conn, close=broken or bool(self._conn.closed))
+            finally:
+                _db_pool_slots.release()
         return False
 
 
 def get_db():
-    if not DATABASE_URL:
-        raise RuntimeError("DATABASE_URL не задан в переменных окружения")
-    conn = psycopg2.connect(DATABASE_URL)
+    """Выдаёт соединение из пула; весь блок `with get_db() as conn:` — одна
+    транзакция: commit при нормальном выходе, rollback при исключении.
+    Если все соединения заняты, вызов блокируется до освобождения."""
+    _db_pool_slots.acquire()
+    try:
+        conn = _get_db_pool().getconn()
+    except BaseException:
+        _db_pool_slots.release()
+        raise
     return DBConnection(conn)
 
 # === Безопасная инициализация БД ===
@@ -173,50 +236,137 @@ def init_database_if_needed():
     except Exception as e:
         print(f"❌ Ошибка при инициализации БД: {e}")
 
-init_database_if_needed()
-
 # === Вспомогательные функции ===
+# \w = буквы/цифры/подчёркивание (включая кириллицу) — совпадает с прежним
+# посимвольным isalnum()-фильтром, но выполняется одним C-вызовом
+_UNSAFE_FILENAME_CHARS = re.compile(r"[^\w.\-]")
+
 def sanitize_filename(filename: str) -> str:
-    safe = "".join(c if c.isalnum() or c in "._-" else "_" for c in filename)
-    return safe[:100]
+    return _UNSAFE_FILENAME_CHARS.sub("_", filename)[:100]
+
+@lru_cache(maxsize=4096)
+def _id_is_valid(id_clean: str) -> bool:
+    return bool(id_clean) and VALID_ID_PATTERN.match(id_clean) is not None
 
 def validate_id(user_id: str) -> str:
+    # Реальных идентификаторов немного — кэшируем результат проверки регулярки.
+    # Кэшируем только булев ответ, а не исключение: lru_cache исключения не хранит.
     id_clean = user_id.strip()
-    if not id_clean or not VALID_ID_PATTERN.match(id_clean):
+    if not _id_is_valid(id_clean):
         raise HTTPException(400, "Некорректный идентификатор")
     return id_clean
 
-def create_session(user_id: int, user_type: str) -> str:
+# SQL сессий выполняется на каждом авторизованном запросе — держим текст запросов
+# в константах, чтобы строки не пересобирались и определение было в одном месте
+# (клиентского кэша подготовленных выражений у psycopg2 нет)
+_SQL_SESSION_SELECT = "SELECT user_id, user_type, expires_at FROM sessions WHERE token = %s"
+_SQL_SESSION_INSERT = """
+    INSERT INTO sessions (token, user_id, user_type, expires_at)
+    VALUES (%s, %s, %s, %s)
+"""
+_SQL_SESSION_DELETE_BY_USER = "DELETE FROM sessions WHERE user_id = %s AND user_type = %s"
+
+# SQL входа — по той же причине, что и SQL сессий выше
+_SQL_STUDENT_BY_LOGIN = """
+    SELECT id, last_name, first_name, patronymic, password_hash
+    FROM students
+    WHERE student_id = %s
+"""
+_SQL_TEACHER_BY_LOGIN = """
+    SELECT id, last_name, first_name, patronymic, password_hash
+    FROM teachers
+    WHERE teacher_id = %s
+"""
+_SQL_ADMIN_BY_LOGIN = "SELECT id, password_hash FROM admins WHERE admin_id = %s"
+# Срок сравнивается с часами приложения, как в create_session/verify_session:
+# если часы БД разойдутся с часами приложения, чистка не должна удалять живые сессии
+_SQL_SESSION_DELETE_EXPIRED = "DELETE FROM sessions WHERE expires_at <= %s"
+
+# Просроченные сессии вычищает фоновый поток (см. startup-хук), а не горячий путь
+# verify_session: проверка токена остаётся чистым SELECT без write-блокировок.
+_SESSION_CLEANUP_INTERVAL = 600
+
+def _session_cleanup_loop():
+    while True:
+        time.sleep(_SESSION_CLEANUP_INTERVAL)
+        try:
+            with get_db() as conn:
+                conn.execute(_SQL_SESSION_DELETE_EXPIRED, (datetime.now(),))
+        except Exception:
+            # Временная недоступность БД не должна ронять поток — повторим позже
+            pass
+
+# Кэш агрегата «преподаватели по предметам студента»: состав преподавателей
+# меняется только через админку, пересчитывать STRING_AGG на каждый вход не нужно.
+# Версия сбрасывает кэш при изменениях, TTL — страховка от пропущенной инвалидации.
+_teachers_agg_cache: dict = {}
+_teachers_agg_version = 0
+_TEACHERS_AGG_TTL = 300
+
+def _bump_teachers_agg_version():
+    global _teachers_agg_version
+    _teachers_agg_version += 1
+    _teachers_agg_cache.clear()
+
+def _rows_as_dicts(cur):
+    """Преобразует все строки курсора в dict, читая описание колонок один раз,
+    а не на каждую строку, как это делает dict(DictRow)."""
+    cols = [c.name for c in cur.description]
+    return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+# Кэш проверенных токенов: verify_session выполняется на каждом авторизованном
+# запросе. TTL короткий; при перелогине и смене пароля записи снимаются явно.
+_session_cache: dict = {}
+_SESSION_CACHE_TTL = 30
+_SESSION_CACHE_MAX = 10000
+
+def _invalidate_session_cache(user_id: int, user_type: str):
+    # Снимок items(): параллельные обработчики пишут в кэш, и итерация по
+    # живому словарю может упасть с "dictionary changed size during iteration"
+    stale = [t for t, (sess, _) in list(_session_cache.items()) if sess == (user_id, user_type)]
+    for t in stale:
+        _session_cache.pop(t, None)
+
+def create_session(conn, user_id: int, user_type: str) -> str:
+    """Пишет сессию через соединение вызывающего (как write_audit): обработчики
+    входа уже держат соединение из пула, и второй get_db() изнутри их блока
+    означал бы вложенный захват пула — путь к взаимной блокировке."""
     token = secrets.token_urlsafe(32)
     expires_at = datetime.now() + timedelta(hours=SESSION_EXPIRE_HOURS)
 
-    with get_db() as conn:
-        conn.execute("DELETE FROM sessions WHERE user_id = %s AND user_type = %s", (user_id, user_type))
-        conn.execute("""
-            INSERT INTO sessions (token, user_id, user_type, expires_at)
-            VALUES (%s, %s, %s, %s)
-        """, (token, user_id, user_type, expires_at))
+    conn.execute(_SQL_SESSION_DELETE_BY_USER, (user_id, user_type))
+    conn.execute(_SQL_SESSION_INSERT, (token, user_id, user_type, expires_at))
+    _invalidate_session_cache(user_id, user_type)
     return token
 
 def verify_session(token: str):
     if not token:
         return None
 
+    cached = _session_cache.get(token)
+    if cached and time.time() - cached[1] < _SESSION_CACHE_TTL:
+        return cached[0]
+
     current_time = datetime.now()
     with get_db() as conn:
-        cur = conn.execute("SELECT user_id, user_type, expires_at FROM sessions WHERE token = %s", (token,))
+        cur = conn.execute(_SQL_SESSION_SELECT, (token,))
         row = cur.fetchone()
         if not row:
+            _session_cache.pop(token, None)
             return None
 
         user_id, user_type, expires_at = row
         if expires_at <= current_time:
-            conn.execute("DELETE FROM sessions WHERE token = %s", (token,))
+            # Саму запись удалит фоновая чистка — здесь достаточно отказа
+            _session_cache.pop(token, None)
             return None
 
+        if len(_session_cache) >= _SESSION_CACHE_MAX:
+            _session_cache.clear()
+        _session_cache[token] = ((user_id, user_type), time.time())
         return (user_id, user_type)
 
-async def require_auth(authorization: str = Header(None)):
+def require_auth(authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(401, "Требуется авторизация")
 
@@ -230,10 +380,18 @@ def _r2_stream(r2_key: str, filename: str) -> StreamingResponse:
     """Стримит файл из R2 клиенту."""
     try:
         obj = get_r2().get_object(Bucket=R2_BUCKET, Key=r2_key)
+        # Ключи содержат метку времени и не перезаписываются — содержимое
+        # неизменно, браузеру можно кэшировать и не скачивать повторно
+        headers = {
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Cache-Control": "private, max-age=86400, immutable",
+        }
+        if obj.get("ETag"):
+            headers["ETag"] = obj["ETag"]
         return StreamingResponse(
             obj["Body"],
             media_type="application/octet-stream",
-            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+            headers=headers,
         )
     except ClientError as e:
         code = e.response["Error"]["Code"]
@@ -241,8 +399,79 @@ def _r2_stream(r2_key: str, filename: str) -> StreamingResponse:
             raise HTTPException(404, "Файл не найден")
         raise HTTPException(500, "Ошибка хранилища")
 
+# === Статусы работ: подписи и преобразования ===
+# Словари раньше пересоздавались внутри обработчиков на каждый запрос
+
+# Подписи статусов отправки (карточки заданий студента и преподавателя)
+_SUBMISSION_STATUS_LABELS = {
+    "submitted": "Отправлено",
+    "in_review": "На рассмотрении",
+    "approved": "Зачтено",
+    "rejected": "Не зачтено",
+    "resubmitted": "Не зачтено (повторно отправлена)",
+    "notebook_sent": "Тетрадь отправлена почтой"
+}
+
+# Подписи для таблицы успеваемости студента (/api/grades/me)
+_GRADES_STATUS_LABELS = {
+    "submitted":     "Отправлено",
+    "in_review":     "На проверке",
+    "approved":      "Зачтено",
+    "rejected":      "Не зачтено",
+    "resubmitted":   "Повторно отправлено",
+    "notebook_sent": "Тетрадь отправлена",
+}
+
+# Подписи для CSV-экспорта успеваемости
+_EXPORT_STATUS_RU = {
+    "submitted":     "Отправлено",
+    "in_review":     "На проверке",
+    "approved":      "Зачтено",
+    "rejected":      "Не зачтено",
+    "resubmitted":   "Повторно отправлено",
+    "notebook_sent": "Тетрадь отправлена",
+    "не сдано":      "Не сдано",
+}
+
+# Оценка преподавателя: допустимые значения и преобразование в статус submissions
+_VALID_GRADE_STATUSES = frozenset({
+    "зачёт", "сдано", "не зачтено", "не допущен", "не сдано",
+    "принят на рассмотрение", "получена",
+})
+_GRADE_STATUS_MAPPING = {
+    "зачёт": "approved",
+    "сдано": "approved",
+    "не зачтено": "rejected",
+    "не допущен": "rejected",
+    "не сдано": "rejected",
+    "получена": "in_review",
+    "принят на рассмотрение": "in_review"
+}
+# Статусы, которым соответствует итоговая оценка 100 («зачтено»)
+_PASS_GRADE_STATUSES = frozenset({"зачёт", "сдано"})
+
+# Подписи для письма студенту об изменении статуса
+_GRADE_EMAIL_LABELS = {
+    "зачёт": "Зачтено",
+    "сдано": "Зачтено",
+    "не зачтено": "Не зачтено — требуется повторная сдача",
+    "не допущен": "Не допущен",
+    "не сдано": "Не зачтено",
+    "получена": "Тетрадь получена преподавателем",
+    "принят на рассмотрение": "Принято на рассмотрение",
+}
+
 # === Приложение ===
-app = FastAPI()
+# orjson сериализует большие JSON-списки (задания, прогресс) в разы быстрее stdlib json
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Инициализация БД — в startup-хуке, а не при импорте модуля: импорт остаётся
+# дешёвым (тесты, reload), а сидирование идемпотентно (проверка количества
+# строк + ON CONFLICT), поэтому параллельный старт воркеров безопасен
+@app.on_event("startup")
+def _init_db_on_startup():
+    init_database_if_needed()
+    threading.Thread(target=_session_cleanup_loop, daemon=True).start()
 
 # Настройка CORS
 _cors_origins_env = os.environ.get("ALLOWED_ORIGINS", "http://localhost:8000,http://127.0.0.1:8000")
@@ -255,32 +484,39 @@ app.add_middleware(
     allow_headers=["Authorization", "Content-Type"],
 )
 
+# Сжатие крупных JSON-ответов (списки заданий, прогресс) и HTML-страниц;
+# мелкие ответы не трогаем, чтобы не платить за gzip больше, чем экономим
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
 # Подключение статики
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 _NO_CACHE = {"Cache-Control": "no-cache, no-store, must-revalidate", "Pragma": "no-cache"}
 
+@lru_cache(maxsize=None)
+def _load_page(filename: str) -> str:
+    """HTML-оболочки страниц меняются только с деплоем — читаем с диска один раз."""
+    with open(f"static/{filename}", encoding="utf-8") as f:
+        return f.read()
+
 @app.get("/", response_class=HTMLResponse)
-async def landing_page():
-    with open("static/landing.html", encoding="utf-8") as f:
-        return HTMLResponse(f.read(), headers=_NO_CACHE)
+def landing_page():
+    return HTMLResponse(_load_page("landing.html"), headers=_NO_CACHE)
 
 @app.get("/student", response_class=HTMLResponse)
-async def student_page():
-    with open("static/student.html", encoding="utf-8") as f:
-        return HTMLResponse(f.read(), headers=_NO_CACHE)
+def student_page():
+    return HTMLResponse(_load_page("student.html"), headers=_NO_CACHE)
 
 @app.get("/teacher", response_class=HTMLResponse)
-async def teacher_page():
-    with open("static/teacher.html", encoding="utf-8") as f:
-        return HTMLResponse(f.read(), headers=_NO_CACHE)
+def teacher_page():
+    return HTMLResponse(_load_page("teacher.html"), headers=_NO_CACHE)
 
 @app.get("/sw.js")
-async def service_worker():
+def service_worker():
     return FileResponse("static/sw.js", media_type="application/javascript")
 
 @app.get("/api/badge")
-async def get_badge(session = Depends(require_auth)):
+def get_badge(session = Depends(require_auth)):
     user_id, user_type = session
     with get_db() as conn:
         if user_type == "student":
@@ -302,26 +538,22 @@ async def get_badge(session = Depends(require_auth)):
 # ===== СТУДЕНТ =====
 
 @app.post("/api/login")
-async def login(request: Request, student_id: str = Form(...), password: str = Form(...)):
+def login(request: Request, student_id: str = Form(...), password: str = Form(...)):
     check_rate_limit(request)
     clean_id = validate_id(student_id)
 
     with get_db() as conn:
-        cur = conn.execute("""
-            SELECT id, last_name, first_name, patronymic, password_hash
-            FROM students
-            WHERE student_id = %s
-        """, (clean_id,))
+        cur = conn.execute(_SQL_STUDENT_BY_LOGIN, (clean_id,))
         student = cur.fetchone()
         if not student or not verify_password(password, student["password_hash"]):
             raise HTTPException(401, "Неверный номер студенческого или пароль")
 
-        token = create_session(student["id"], "student")
+        token = create_session(conn, student["id"], "student")
         user = {k: student[k] for k in ("id", "last_name", "first_name", "patronymic")}
         return {"token": token, "user": user}
 
 @app.post("/api/submit/{assignment_id}")
-async def submit_work(
+def submit_work(
     assignment_id: int,
     background_tasks: BackgroundTasks,
     files: list[UploadFile] = File(...),
@@ -338,52 +570,39 @@ async def submit_work(
 
     with get_db() as conn:
         cur = conn.execute("""
-            SELECT a.id, a.title, s.name AS subject
+            SELECT a.id, a.title, s.name AS subject,
+                   EXISTS (
+                       SELECT 1 FROM grades g
+                       WHERE g.subject_id = a.subject_id AND g.student_id = %s
+                   ) AS graded,
+                   (SELECT st.last_name || ' ' || st.first_name
+                    FROM students st WHERE st.id = %s) AS student_name
             FROM assignments a JOIN subjects s ON a.subject_id = s.id
             WHERE a.id = %s
-        """, (assignment_id,))
+        """, (user_id, user_id, assignment_id))
         assignment_row = cur.fetchone()
         if not assignment_row:
             raise HTTPException(404, "Задание не найдено")
-
-        cur = conn.execute("""
-            SELECT 1 FROM grades g
-            JOIN assignments a ON a.subject_id = g.subject_id
-            WHERE a.id = %s AND g.student_id = %s
-        """, (assignment_id, user_id))
-        if cur.fetchone():
+        if assignment_row["graded"]:
             raise HTTPException(409, "Оценка по предмету уже выставлена. Повторная сдача недоступна.")
         assignment_title = assignment_row["title"]
         subject_name = assignment_row["subject"]
+        student_name = assignment_row["student_name"] or "Студент"
 
-        conn.execute("""
-            INSERT INTO submissions (student_id, assignment_id, status)
-            VALUES (%s, %s, 'submitted')
-            ON CONFLICT (student_id, assignment_id) DO NOTHING
-        """, (user_id, assignment_id))
-
+        # Одна команда вместо INSERT + SELECT + UPDATE: при повторной сдаче
+        # отклонённая работа помечается 'resubmitted', RETURNING отдаёт id и статус
         cur = conn.execute("""
-            SELECT id, status FROM submissions
-            WHERE student_id = %s AND assignment_id = %s
+            INSERT INTO submissions (student_id, assignment_id, status, submitted_at)
+            VALUES (%s, %s, 'submitted', CURRENT_TIMESTAMP)
+            ON CONFLICT (student_id, assignment_id) DO UPDATE
+            SET status = CASE WHEN submissions.status = 'rejected'
+                              THEN 'resubmitted' ELSE 'submitted' END,
+                submitted_at = CURRENT_TIMESTAMP
+            RETURNING id, status
         """, (user_id, assignment_id))
         submission_row = cur.fetchone()
         submission_id = submission_row[0]
-        current_status = submission_row[1]
-
-        new_status = "resubmitted" if current_status == "rejected" else "submitted"
-
-        conn.execute("""
-            UPDATE submissions
-            SET status = %s, submitted_at = CURRENT_TIMESTAMP
-            WHERE id = %s
-        """, (new_status, submission_id))
-
-        cur = conn.execute("""
-            SELECT st.last_name, st.first_name
-            FROM students st WHERE st.id = %s
-        """, (user_id,))
-        student_row = cur.fetchone()
-        student_name = f"{student_row['last_name']} {student_row['first_name']}" if student_row else "Студент"
+        new_status = submission_row[1]
 
         cur = conn.execute("""
             SELECT t.email FROM teachers t
@@ -394,24 +613,30 @@ async def submit_work(
         teacher_emails = [row[0] for row in cur.fetchall()]
 
         r2 = get_r2()
-        saved_count = 0
-        for file in files:
+        # Метка времени и префикс ключа одинаковы для всех файлов отправки —
+        # считаем один раз, а уникальность внутри пачки даёт порядковый номер
+        timestamp = time.strftime("%Y%m%d_%H%M%S")
+        key_prefix = f"submissions/{user_id}/{assignment_id}/{timestamp}"
+        file_rows = []
+        for idx, file in enumerate(files):
             if not file.filename:
                 continue
             ext = os.path.splitext(file.filename)[1].lower()
             if ext not in ALLOWED_EXTENSIONS:
                 raise HTTPException(400, f"Тип файла «{ext}» не разрешён. Допустимые форматы: PDF, DOC, DOCX, XLS, XLSX, ZIP, PNG, JPG и др.")
-            if file.size > MAX_FILE_SIZE:
+            # file.size = None, если клиент не передал размер части, — не пропускаем
+            if file.size is None or file.size > MAX_FILE_SIZE:
                 raise HTTPException(400, f"Файл {file.filename} слишком большой (макс. 10 МБ)")
             safe_name = sanitize_filename(file.filename)
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            r2_key = f"submissions/{user_id}/{assignment_id}/{timestamp}_{safe_name}"
-            r2.upload_fileobj(file.file, R2_BUCKET, r2_key)
-            conn.execute("""
+            r2_key = f"{key_prefix}_{idx:02d}_{safe_name}"
+            r2.upload_fileobj(file.file, R2_BUCKET, r2_key, Config=_R2_TRANSFER)
+            file_rows.append((submission_id, r2_key))
+        if file_rows:
+            conn.executemany("""
                 INSERT INTO submission_files (submission_id, file_path)
                 VALUES (%s, %s)
-            """, (submission_id, r2_key))
-            saved_count += 1
+            """, file_rows)
+        saved_count = len(file_rows)
 
     action = "повторно отправил" if new_status == "resubmitted" else "отправил"
     email_subject = f"Новая работа на проверку — {assignment_title}"
@@ -425,7 +650,7 @@ async def submit_work(
     return {"message": f"Отправлено {saved_count} файлов"}
 
 @app.post("/api/submit-notebook/{assignment_id}")
-async def submit_notebook(
+def submit_notebook(
     assignment_id: int,
     background_tasks: BackgroundTasks,
     session = Depends(require_auth)
@@ -436,15 +661,18 @@ async def submit_notebook(
 
     with get_db() as conn:
         cur = conn.execute("""
-            SELECT a.id, a.title, a.submission_type, s.name AS subject
+            SELECT a.id, a.title, a.submission_type, s.name AS subject,
+                   (SELECT st.last_name || ' ' || st.first_name
+                    FROM students st WHERE st.id = %s) AS student_name
             FROM assignments a JOIN subjects s ON a.subject_id = s.id
             WHERE a.id = %s
-        """, (assignment_id,))
+        """, (user_id, assignment_id))
         assignment_row = cur.fetchone()
         if not assignment_row:
             raise HTTPException(404, "Задание не найдено")
         if assignment_row["submission_type"] != "notebook":
             raise HTTPException(400, "Это задание сдаётся в электронном виде")
+        student_name = assignment_row["student_name"] or "Студент"
 
         cur = conn.execute("""
             SELECT id, status FROM submissions
@@ -462,12 +690,6 @@ async def submit_notebook(
             DO UPDATE SET status = 'notebook_sent', submitted_at = CURRENT_TIMESTAMP
         """, (user_id, assignment_id))
 
-        cur = conn.execute("""
-            SELECT last_name, first_name FROM students WHERE id = %s
-        """, (user_id,))
-        student_row = cur.fetchone()
-        student_name = f"{student_row['last_name']} {student_row['first_name']}" if student_row else "Студент"
-
         cur = conn.execute("""
             SELECT t.email FROM teachers t
             JOIN subject_teachers st_link ON t.id = st_link.teacher_id
@@ -491,89 +713,58 @@ async def submit_notebook(
 
 # Эндпоинты для студентов (/me)
 @app.get("/api/assignments/me")
-async def get_my_assignments(session = Depends(require_auth)):
+def get_my_assignments(session = Depends(require_auth)):
     user_id, user_type = session
     if user_type != "student":
         raise HTTPException(403, "Доступ запрещён")
 
     with get_db() as conn:
+        # Одним запросом: задания + своя отправка + признак файлов преподавателя
+        # + итоговая оценка по предмету (раньше — четыре запроса и сведение
+        # словарями в Python)
         cur = conn.execute("""
             SELECT a.id, a.title, a.description, a.deadline, a.submission_type,
-                   s.id AS subject_id, s.name AS subject
+                   s.id AS subject_id, s.name AS subject,
+                   sub.id AS submission_id, sub.status, sub.submitted_at, sub.review,
+                   EXISTS (
+                       SELECT 1 FROM teacher_feedback_files tff
+                       WHERE tff.submission_id = sub.id
+                   ) AS has_teacher_feedback,
+                   g.status AS final_grade_status
             FROM assignments a
             JOIN subjects s ON a.subject_id = s.id
             JOIN student_subjects ss ON s.id = ss.subject_id
+            LEFT JOIN submissions sub
+                   ON sub.assignment_id = a.id AND sub.student_id = ss.student_id
+            LEFT JOIN grades g
+                   ON g.subject_id = s.id AND g.student_id = ss.student_id
             WHERE ss.student_id = %s
             ORDER BY a.deadline
         """, (user_id,))
         assignments_raw = cur.fetchall()
 
-        all_assignment_ids = [a["id"] for a in assignments_raw]
-
-        cur = conn.execute("""
-            SELECT id, assignment_id, status, submitted_at, review
-            FROM submissions
-            WHERE student_id = %s
-        """, (user_id,))
-        submission_map = {}
-        for row in cur.fetchall():
-            submission_map[row["assignment_id"]] = {
-                "submission_id": row["id"],
-                "status": row["status"],
-                "submitted_at": row["submitted_at"],
-                "review": row["review"]
-            }
-
-        for aid in all_assignment_ids:
-            if aid not in submission_map:
-                submission_map[aid] = {
-                    "submission_id": None,
-                    "status": None,
-                    "submitted_at": None,
-                    "review": None
-                }
-
-        cur = conn.execute("""
-            SELECT s.id AS subject_id,
-                   STRING_AGG(
-                       t.last_name || ' ' || substring(t.first_name, 1, 1) || '.' ||
-                       CASE WHEN t.patronymic IS NOT NULL
-                           THEN substring(t.patronymic, 1, 1) || '.'
-                           ELSE '' END,
-                       ', '
-                   ) AS teachers
-            FROM subjects s
-            JOIN subject_teachers st_link ON s.id = st_link.subject_id
-            JOIN teachers t ON st_link.teacher_id = t.id
-            GROUP BY s.id
-        """)
-        teacher_map = {row["subject_id"]: row["teachers"] or "—" for row in cur.fetchall()}
-
-        submission_ids = [v["submission_id"] for v in submission_map.values() if v["submission_id"]]
-        has_feedback = set()
-        if submission_ids:
-            placeholders = ','.join(['%s'] * len(submission_ids))
-            cur = conn.execute(f"""
-                SELECT submission_id FROM teacher_feedback_files
-                WHERE submission_id IN ({placeholders})
-            """, submission_ids)
-            has_feedback = {row[0] for row in cur.fetchall()}
-
-        cur = conn.execute("""
-            SELECT subject_id, status
-            FROM grades
-            WHERE student_id = %s
-        """, (user_id,))
-        grade_map = {row["subject_id"]: row["status"] for row in cur.fetchall()}
-
-        STATUS_LABELS = {
-            "submitted": "Отправлено",
-            "in_review": "На рассмотрении",
-            "approved": "Зачтено",
-            "rejected": "Не зачтено",
-            "resubmitted": "Не зачтено (повторно отправлена)",
-            "notebook_sent": "Тетрадь отправлена почтой"
-        }
+        cached = _teachers_agg_cache.get(user_id)
+        if cached and cached[0] == _teachers_agg_version and time.time() - cached[1] < _TEACHERS_AGG_TTL:
+            teacher_map = cached[2]
+        else:
+            cur = conn.execute("""
+                SELECT s.id AS subject_id,
+                       STRING_AGG(
+                           t.last_name || ' ' || substring(t.first_name, 1, 1) || '.' ||
+                           CASE WHEN t.patronymic IS NOT NULL
+                               THEN substring(t.patronymic, 1, 1) || '.'
+                               ELSE '' END,
+                           ', '
+                       ) AS teachers
+                FROM subjects s
+                JOIN student_subjects ss ON ss.subject_id = s.id
+                JOIN subject_teachers st_link ON s.id = st_link.subject_id
+                JOIN teachers t ON st_link.teacher_id = t.id
+                WHERE ss.student_id = %s
+                GROUP BY s.id
+            """, (user_id,))
+            teacher_map = {row["subject_id"]: row["teachers"] or "—" for row in cur.fetchall()}
+            _teachers_agg_cache[user_id] = (_teachers_agg_version, time.time(), teacher_map)
 
         return [
             {
@@ -584,37 +775,30 @@ async def get_my_assignments(session = Depends(require_auth)):
                 "description": a["description"],
                 "deadline": a["deadline"],
                 "submission_type": a["submission_type"] or "electronic",
-                "status": submission_map[a["id"]]["status"],
-                "status_label": STATUS_LABELS.get(submission_map[a["id"]]["status"], "Не отправлено"),
-                "submitted_at": submission_map[a["id"]]["submitted_at"],
-                "review": submission_map[a["id"]]["review"],
-                "submission_id": submission_map[a["id"]]["submission_id"],
-                "has_teacher_feedback": submission_map[a["id"]]["submission_id"] in has_feedback,
-                "final_grade_blocked": a["subject_id"] in grade_map,
-                "final_grade_status": grade_map.get(a["subject_id"])
+                "status": a["status"],
+                "status_label": _SUBMISSION_STATUS_LABELS.get(a["status"], "Не отправлено"),
+                "submitted_at": a["submitted_at"],
+                "review": a["review"],
+                "submission_id": a["submission_id"],
+                "has_teacher_feedback": a["has_teacher_feedback"],
+                "final_grade_blocked": a["final_grade_status"] is not None,
+                "final_grade_status": a["final_grade_status"]
             }
             for a in assignments_raw
         ]
 
 @app.get("/api/grades/me")
-async def get_my_grades(session = Depends(require_auth)):
+def get_my_grades(session = Depends(require_auth)):
     user_id, user_type = session
     if user_type != "student":
         raise HTTPException(403, "Доступ запрещён")
 
-    STATUS_LABELS = {
-        "submitted":     "Отправлено",
-        "in_review":     "На проверке",
-        "approved":      "Зачтено",
-        "rejected":      "Не зачтено",
-        "resubmitted":   "Повторно отправлено",
-        "notebook_sent": "Тетрадь отправлена",
-    }
-
     with get_db() as conn:
+        # Дату форматирует Postgres: без per-row strftime/fromisoformat в Python
         cur = conn.execute("""
             SELECT s.name AS subject, a.title AS assignment_title,
-                   sub.status, sub.submitted_at
+                   sub.status,
+                   COALESCE(to_char(sub.submitted_at, 'DD.MM.YYYY, HH24:MI'), '—') AS submitted_at
             FROM submissions sub
             JOIN assignments a ON sub.assignment_id = a.id
             JOIN subjects s ON a.subject_id = s.id
@@ -622,31 +806,21 @@ async def get_my_grades(session = Depends(require_auth)):
             ORDER BY sub.submitted_at DESC NULLS LAST
         """, (user_id,))
 
-        result = []
-        for row in cur.fetchall():
-            ts = row["submitted_at"]
-            formatted_date = "—"
-            if ts:
-                if isinstance(ts, datetime):
-                    formatted_date = ts.strftime("%d.%m.%Y, %H:%M")
-                else:
-                    try:
-                        formatted_date = datetime.fromisoformat(str(ts)).strftime("%d.%m.%Y, %H:%M")
-                    except ValueError:
-                        pass
-            result.append({
+        return [
+            {
                 "subject":          row["subject"],
                 "assignment_title": row["assignment_title"],
                 "status":           row["status"],
-                "status_label":     STATUS_LABELS.get(row["status"], row["status"] or "—"),
-                "submitted_at":     formatted_date,
-            })
-        return result
+                "status_label":     _GRADES_STATUS_LABELS.get(row["status"], row["status"] or "—"),
+                "submitted_at":     row["submitted_at"],
+            }
+            for row in cur.fetchall()
+        ]
 
 # ===== ОБЩЕЕ =====
 
 @app.post("/api/change-password")
-async def change_password(
+def change_password(
     old_password: str = Form(...),
     new_password: str = Form(...),
     session = Depends(require_auth)
@@ -667,36 +841,30 @@ async def change_password(
             f"UPDATE {table} SET password_hash = %s WHERE id = %s",
             (hash_password(new_password), user_id)
         )
-        conn.execute(
-            "DELETE FROM sessions WHERE user_id = %s AND user_type = %s",
-            (user_id, user_type)
-        )
+        conn.execute(_SQL_SESSION_DELETE_BY_USER, (user_id, user_type))
+    _invalidate_session_cache(user_id, user_type)
     return {"ok": True}
 
 
 # ===== ПРЕПОДАВАТЕЛЬ =====
 
 @app.post("/api/teacher/login")
-async def teacher_login(request: Request, teacher_id: str = Form(...), password: str = Form(...)):
+def teacher_login(request: Request, teacher_id: str = Form(...), password: str = Form(...)):
     check_rate_limit(request)
     clean_id = validate_id(teacher_id)
 
     with get_db() as conn:
-        cur = conn.execute("""
-            SELECT id, last_name, first_name, patronymic, password_hash
-            FROM teachers
-            WHERE teacher_id = %s
-        """, (clean_id,))
+        cur = conn.execute(_SQL_TEACHER_BY_LOGIN, (clean_id,))
         teacher = cur.fetchone()
         if not teacher or not verify_password(password, teacher["password_hash"]):
             raise HTTPException(401, "Неверный ID преподавателя или пароль")
 
-        token = create_session(teacher["id"], "teacher")
+        token = create_session(conn, teacher["id"], "teacher")
         user = {k: teacher[k] for k in ("id", "last_name", "first_name", "patronymic")}
         return {"token": token, "user": user}
 
 @app.get("/api/teacher/assignments/me")
-async def get_my_teacher_assignments(session = Depends(require_auth)):
+def get_my_teacher_assignments(session = Depends(require_auth)):
     user_id, user_type = session
     if user_type != "teacher":
         raise HTTPException(403, "Доступ запрещён")
@@ -734,15 +902,6 @@ async def get_my_teacher_assignments(session = Depends(require_auth)):
             ORDER BY a.deadline DESC, st.last_name
         """, (user_id,))
 
-        STATUS_LABELS = {
-            "submitted": "Отправлено",
-            "in_review": "На рассмотрении",
-            "approved": "Зачтено",
-            "rejected": "Не зачтено",
-            "resubmitted": "Не зачтено (повторно отправлена)",
-            "notebook_sent": "Тетрадь отправлена почтой"
-        }
-
         result = []
         for row in cur.fetchall():
             stype = row["submission_type"] or "electronic"
@@ -750,7 +909,7 @@ async def get_my_teacher_assignments(session = Depends(require_auth)):
             if last_status is None and stype == "notebook":
                 status_label = "Нет в кабинете"
             else:
-                status_label = STATUS_LABELS.get(last_status, "Не отмечено")
+                status_label = _SUBMISSION_STATUS_LABELS.get(last_status, "Не отмечено")
             result.append({
                 "assignment_id": row["assignment_id"],
                 "title": row["title"],
@@ -768,7 +927,7 @@ async def get_my_teacher_assignments(session = Depends(require_auth)):
         return result
 
 @app.get("/api/teacher/stats/me")
-async def get_teacher_stats(session = Depends(require_auth)):
+def get_teacher_stats(session = Depends(require_auth)):
     user_id, user_type = session
     if user_type != "teacher":
         raise HTTPException(403, "Доступ запрещён")
@@ -807,7 +966,7 @@ async def get_teacher_stats(session = Depends(require_auth)):
     return {"pending": pending, "overdue": overdue, "subjects": subjects}
 
 @app.get("/api/teacher/history/me")
-async def get_my_teacher_history(session = Depends(require_auth)):
+def get_my_teacher_history(session = Depends(require_auth)):
     user_id, user_type = session
     if user_type != "teacher":
         raise HTTPException(403, "Доступ запрещён")
@@ -831,10 +990,10 @@ async def get_my_teacher_history(session = Depends(require_auth)):
               AND g.status IN ('зачёт', 'сдано')
             ORDER BY g.graded_at DESC
         """, (user_id,))
-        return [dict(row) for row in cur.fetchall()]
+        return _rows_as_dicts(cur)
 
 @app.get("/api/teacher/files/{assignment_id}/{student_id}")
-async def get_submission_files(
+def get_submission_files(
     assignment_id: int,
     student_id: str,
     session = Depends(require_auth)
@@ -863,7 +1022,7 @@ async def get_submission_files(
         ]
 
 @app.post("/api/teacher/grade")
-async def set_grade(
+def set_grade(
     background_tasks: BackgroundTasks,
     student_id: str = Form(...),
     subject_name: str = Form(...),
@@ -888,73 +1047,56 @@ async def set_grade(
         student_name = f"{student_row['last_name']} {student_row['first_name']}"
         student_email = student_row["email"]
 
-        cur = conn.execute("SELECT id FROM subjects WHERE name = %s", (subject_name,))
+        cur = conn.execute("""
+            SELECT s.id AS subject_id,
+                   EXISTS (
+                       SELECT 1 FROM subject_teachers st
+                       WHERE st.subject_id = s.id AND st.teacher_id = %s
+                   ) AS teaches,
+                   a.id AS assignment_ok, a.title, a.submission_type
+            FROM subjects s
+            LEFT JOIN assignments a ON a.id = %s AND a.subject_id = s.id
+            WHERE s.name = %s
+        """, (user_id, assignment_id, subject_name))
         subject_row = cur.fetchone()
         if not subject_row:
             raise HTTPException(404, "Предмет не найден")
-        subject_id_int = subject_row[0]
-
-        cur = conn.execute("""
-            SELECT 1 FROM subject_teachers
-            WHERE subject_id = %s AND teacher_id = %s
-        """, (subject_id_int, user_id))
-        if not cur.fetchone():
+        if not subject_row["teaches"]:
             raise HTTPException(403, "Вы не ведёте этот предмет")
-
-        cur = conn.execute("""
-            SELECT 1 FROM assignments WHERE id = %s AND subject_id = %s
-        """, (assignment_id, subject_id_int))
-        if not cur.fetchone():
+        if not subject_row["assignment_ok"]:
             raise HTTPException(403, "Задание не принадлежит этому предмету")
+        subject_id_int = subject_row["subject_id"]
+        assignment_title = subject_row["title"]
+        is_notebook = subject_row["submission_type"] == "notebook"
 
-        cur = conn.execute("""
-            SELECT title, submission_type FROM assignments WHERE id = %s
-        """, (assignment_id,))
-        assignment_row = cur.fetchone()
-        assignment_title = assignment_row["title"] if assignment_row else "Задание"
-        is_notebook = (assignment_row["submission_type"] == "notebook") if assignment_row else False
-
-        VALID_STATUSES = {"зачёт", "сдано", "не зачтено", "не допущен", "не сдано",
-                          "принят на рассмотрение", "получена"}
-        if status_input not in VALID_STATUSES:
+        if status_input not in _VALID_GRADE_STATUSES:
             raise HTTPException(400, "Недопустимый статус")
 
         if status_input == "получена" and not is_notebook:
             raise HTTPException(400, "Статус «получена» применим только к тетрадным заданиям")
 
-        if status_input == "не зачтено":
+        if status_input == "не зачтено" and not is_notebook:
+            # Удаляем записи и получаем ключи R2 одним запросом вместо
+            # SELECT id → SELECT file_path → DELETE
             cur = conn.execute("""
-                SELECT id FROM submissions
-                WHERE student_id = %s AND assignment_id = %s
-            """, (student_id_int, assignment_id))
-            submission_row = cur.fetchone()
-            if submission_row and not is_notebook:
-                submission_id = submission_row[0]
-                cur = conn.execute(
-                    "SELECT file_path FROM submission_files WHERE submission_id = %s",
-                    (submission_id,)
+                DELETE FROM submission_files
+                WHERE submission_id = (
+                    SELECT id FROM submissions
+                    WHERE student_id = %s AND assignment_id = %s
                 )
-                r2_keys = [row[0] for row in cur.fetchall()]
-                if r2_keys:
-                    try:
-                        get_r2().delete_objects(
-                            Bucket=R2_BUCKET,
-                            Delete={"Objects": [{"Key": k} for k in r2_keys]},
-                        )
-                    except ClientError:
-                        pass
-                conn.execute("DELETE FROM submission_files WHERE submission_id = %s", (submission_id,))
-
-        status_mapping = {
-            "зачёт": "approved",
-            "сдано": "approved",
-            "не зачтено": "rejected",
-            "не допущен": "rejected",
-            "не сдано": "rejected",
-            "получена": "in_review",
-            "принят на рассмотрение": "in_review"
-        }
-        db_status = status_mapping.get(status_input, "submitted")
+                RETURNING file_path
+            """, (student_id_int, assignment_id))
+            r2_keys = [row[0] for row in cur.fetchall()]
+            if r2_keys:
+                try:
+                    get_r2().delete_objects(
+                        Bucket=R2_BUCKET,
+                        Delete={"Objects": [{"Key": k} for k in r2_keys]},
+                    )
+                except ClientError:
+                    pass
+
+        db_status = _GRADE_STATUS_MAPPING.get(status_input, "submitted")
 
         # Для тетрадных заданий создаём запись submission если её нет
         if is_notebook:
@@ -972,7 +1114,7 @@ async def set_grade(
 
         # "Получена" — только факт получения, итоговую оценку не выставляем
         if status_input != "получена":
-            grade_value = 100 if status_input in ("зачёт", "сдано") else None
+            grade_value = 100 if status_input in _PASS_GRADE_STATUSES else None
             conn.execute("""
                 INSERT INTO grades (student_id, subject_id, grade, status, review, graded_at)
                 VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
@@ -985,16 +1127,7 @@ async def set_grade(
             """, (student_id_int, subject_id_int, grade_value, status_input, review))
 
     if student_email:
-        STATUS_LABELS = {
-            "зачёт": "Зачтено",
-            "сдано": "Зачтено",
-            "не зачтено": "Не зачтено — требуется повторная сдача",
-            "не допущен": "Не допущен",
-            "не сдано": "Не зачтено",
-            "получена": "Тетрадь получена преподавателем",
-            "принят на рассмотрение": "Принято на рассмотрение",
-        }
-        status_label = STATUS_LABELS.get(status_input, status_input)
+        status_label = _GRADE_EMAIL_LABELS.get(status_input, status_input)
         review_line = f"Рецензия: {review}" if review else ""
         email_body = (
             f"Здравствуйте, {student_name}!\n\n"
@@ -1015,7 +1148,7 @@ async def set_grade(
 # ===== ФАЙЛЫ ОБРАТНОЙ СВЯЗИ ОТ ПРЕПОДАВАТЕЛЯ =====
 
 @app.post("/api/teacher/feedback/{assignment_id}/{student_id}")
-async def upload_feedback_file(
+def upload_feedback_file(
     assignment_id: int,
     student_id: str,
     file: UploadFile = File(...),
@@ -1028,7 +1161,7 @@ async def upload_feedback_file(
     clean_student_id = validate_id(student_id)
     if not file.filename:
         raise HTTPException(400, "Файл не выбран")
-    if file.size > MAX_FILE_SIZE:
+    if file.size is None or file.size > MAX_FILE_SIZE:
         raise HTTPException(400, "Файл слишком большой (макс. 10 МБ)")
 
     with get_db() as conn:
@@ -1048,10 +1181,10 @@ async def upload_feedback_file(
         submission_id = submission_row[0]
 
         safe_name = sanitize_filename(file.filename)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        timestamp = time.strftime("%Y%m%d_%H%M%S")
         r2_key = f"feedback/{clean_student_id}/{assignment_id}/{timestamp}_{safe_name}"
 
-        get_r2().upload_fileobj(file.file, R2_BUCKET, r2_key)
+        get_r2().upload_fileobj(file.file, R2_BUCKET, r2_key, Config=_R2_TRANSFER)
 
         conn.execute("""
             INSERT INTO teacher_feedback_files (submission_id, file_path)
@@ -1061,7 +1194,7 @@ async def upload_feedback_file(
         return {"message": "Файл комментария сохранён"}
 
 @app.get("/api/download/feedback/{submission_id}")
-async def download_feedback_file(submission_id: int, session = Depends(require_auth)):
+def download_feedback_file(submission_id: int, session = Depends(require_auth)):
     user_id, user_type = session
     if user_type != "student":
         raise HTTPException(403, "Доступ запрещён")
@@ -1086,11 +1219,10 @@ async def download_feedback_file(submission_id: int, session = Depends(require_a
 # ===== АДМИНИСТРАТОР =====
 
 @app.get("/admin", response_class=HTMLResponse)
-async def admin_page():
-    with open("static/admin.html", encoding="utf-8") as f:
-        return HTMLResponse(f.read(), headers=_NO_CACHE)
+def admin_page():
+    return HTMLResponse(_load_page("admin.html"), headers=_NO_CACHE)
 
-async def require_admin(authorization: str = Header(None)):
+def require_admin(authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(401, "Требуется авторизация")
     token = authorization.split(" ", 1)[1]
@@ -1103,19 +1235,19 @@ async def require_admin(authorization: str = Header(None)):
     return user_id
 
 @app.post("/api/admin/login")
-async def admin_login(request: Request, admin_id: str = Form(...), password: str = Form(...)):
+def admin_login(request: Request, admin_id: str = Form(...), password: str = Form(...)):
     check_rate_limit(request)
     clean_id = validate_id(admin_id)
     with get_db() as conn:
-        cur = conn.execute("SELECT id, password_hash FROM admins WHERE admin_id = %s", (clean_id,))
+        cur = conn.execute(_SQL_ADMIN_BY_LOGIN, (clean_id,))
         admin = cur.fetchone()
         if not admin or not verify_password(password, admin["password_hash"]):
             raise HTTPException(401, "Неверный логин или пароль")
-        token = create_session(admin["id"], "admin")
+        token = create_session(conn, admin["id"], "admin")
         return {"token": token}
 
 @app.post("/api/admin/change-password")
-async def admin_change_password(
+def admin_change_password(
     old_password: str = Form(...),
     new_password: str = Form(...),
     admin_id = Depends(require_admin)
@@ -1139,17 +1271,17 @@ def write_audit(conn, action: str, entity: str, entity_name: str = None, details
     )
 
 @app.get("/api/admin/audit-log")
-async def admin_audit_log_list(admin_id = Depends(require_admin)):
+def admin_audit_log_list(admin_id = Depends(require_admin)):
     with get_db() as conn:
         cur = conn.execute(
             "SELECT id, action, entity, entity_name, details, created_at FROM admin_audit_log ORDER BY created_at DESC LIMIT 500"
         )
-        return [dict(r) for r in cur.fetchall()]
+        return _rows_as_dicts(cur)
 
 # --- Студенты ---
 
 @app.get("/api/admin/stats")
-async def admin_stats(admin_id = Depends(require_admin)):
+def admin_stats(admin_id = Depends(require_admin)):
     with get_db() as conn:
         students = conn.execute("SELECT COUNT(*) FROM students").fetchone()[0]
         teachers = conn.execute("SELECT COUNT(*) FROM teachers").fetchone()[0]
@@ -1174,7 +1306,7 @@ async def admin_stats(admin_id = Depends(require_admin)):
     return {"students": students, "teachers": teachers, "pending": pending, "overdue": overdue}
 
 @app.get("/api/admin/pending-details")
-async def admin_pending_details(admin_id = Depends(require_admin)):
+def admin_pending_details(admin_id = Depends(require_admin)):
     with get_db() as conn:
         cur = conn.execute("""
             SELECT
@@ -1199,10 +1331,10 @@ async def admin_pending_details(admin_id = Depends(require_admin)):
             WHERE sub.status IN ('submitted', 'in_review', 'resubmitted', 'notebook_sent')
             ORDER BY sub.submitted_at ASC NULLS LAST
         """)
-        return [dict(row) for row in cur.fetchall()]
+        return _rows_as_dicts(cur)
 
 @app.get("/api/admin/overdue-details")
-async def admin_overdue_details(admin_id = Depends(require_admin)):
+def admin_overdue_details(admin_id = Depends(require_admin)):
     with get_db() as conn:
         cur = conn.execute("""
             SELECT
@@ -1231,10 +1363,10 @@ async def admin_overdue_details(admin_id = Depends(require_admin)):
               )
             ORDER BY a.deadline ASC
         """)
-        return [dict(row) for row in cur.fetchall()]
+        return _rows_as_dicts(cur)
 
 @app.get("/api/admin/export/students")
-async def admin_export_students(admin_id = Depends(require_admin)):
+def admin_export_students(admin_id = Depends(require_admin)):
     with get_db() as conn:
         rows = conn.execute("""
             SELECT student_id, last_name, first_name, patronymic, group_name, email
@@ -1251,7 +1383,7 @@ async def admin_export_students(admin_id = Depends(require_admin)):
         headers={"Content-Disposition": "attachment; filename=students.csv"})
 
 @app.get("/api/admin/export/grades")
-async def admin_export_grades(admin_id = Depends(require_admin)):
+def admin_export_grades(admin_id = Depends(require_admin)):
     with get_db() as conn:
         rows = conn.execute("""
             SELECT st.student_id, st.last_name, st.first_name, st.group_name,
@@ -1265,22 +1397,13 @@ async def admin_export_grades(admin_id = Depends(require_admin)):
             LEFT JOIN submissions sub ON sub.student_id = ss.student_id AND sub.assignment_id = a.id
             ORDER BY st.group_name, st.last_name, subj.name, a.title
         """).fetchall()
-    STATUS_RU = {
-        "submitted":     "Отправлено",
-        "in_review":     "На проверке",
-        "approved":      "Зачтено",
-        "rejected":      "Не зачтено",
-        "resubmitted":   "Повторно отправлено",
-        "notebook_sent": "Тетрадь отправлена",
-        "не сдано":      "Не сдано",
-    }
     buf = io.StringIO()
     w = csv.writer(buf)
     w.writerow(["ID студента", "Фамилия", "Имя", "Группа", "Предмет", "Задание", "Дедлайн", "Статус", "Дата сдачи"])
     for r in rows:
         deadline = r[6].strftime("%d.%m.%Y") if r[6] else ""
         submitted = r[8].strftime("%d.%m.%Y %H:%M") if r[8] else ""
-        status_ru = STATUS_RU.get(r[7], r[7])
+        status_ru = _EXPORT_STATUS_RU.get(r[7], r[7])
         w.writerow([r[0], r[1], r[2], r[3] or "", r[4], r[5], deadline, status_ru, submitted])
     buf.seek(0)
     from urllib.parse import quote
@@ -1290,16 +1413,16 @@ async def admin_export_grades(admin_id = Depends(require_admin)):
         headers={"Content-Disposition": f"attachment; filename*=UTF-8''{fname}"})
 
 @app.get("/api/admin/students")
-async def admin_list_students(admin_id = Depends(require_admin)):
+def admin_list_students(admin_id = Depends(require_admin)):
     with get_db() as conn:
         cur = conn.execute("""
             SELECT id, student_id, last_name, first_name, patronymic, group_name, email
             FROM students ORDER BY last_name, first_name
         """)
-        return [dict(r) for r in cur.fetchall()]
+        return _rows_as_dicts(cur)
 
 @app.post("/api/admin/students")
-async def admin_add_student(
+def admin_add_student(
     student_id: str = Form(...),
     last_name: str = Form(...),
     first_name: str = Form(...),
@@ -1323,7 +1446,7 @@ async def admin_add_student(
     return {"ok": True, "temp_password": temp_password}
 
 @app.put("/api/admin/students/{student_db_id}")
-async def admin_edit_student(
+def admin_edit_student(
     student_db_id: int,
     last_name: str = Form(...),
     first_name: str = Form(...),
@@ -1345,7 +1468,7 @@ async def admin_edit_student(
     return {"ok": True}
 
 @app.post("/api/admin/students/{student_db_id}/reset-password")
-async def admin_reset_student_password(student_db_id: int, admin_id = Depends(require_admin)):
+def admin_reset_student_password(student_db_id: int, admin_id = Depends(require_admin)):
     with get_db() as conn:
         cur = conn.execute("SELECT student_id, last_name, first_name FROM students WHERE id = %s", (student_db_id,))
         row = cur.fetchone()
@@ -1358,7 +1481,7 @@ async def admin_reset_student_password(student_db_id: int, admin_id = Depends(re
     return {"ok": True, "temp_password": temp_password}
 
 @app.delete("/api/admin/students/{student_db_id}")
-async def admin_delete_student(student_db_id: int, admin_id = Depends(require_admin)):
+def admin_delete_student(student_db_id: int, admin_id = Depends(require_admin)):
     with get_db() as conn:
         cur = conn.execute("SELECT student_id, last_name, first_name FROM students WHERE id = %s", (student_db_id,))
         row = cur.fetchone()
@@ -1371,16 +1494,16 @@ async def admin_delete_student(student_db_id: int, admin_id = Depends(require_ad
 # --- Преподаватели ---
 
 @app.get("/api/admin/teachers")
-async def admin_list_teachers(admin_id = Depends(require_admin)):
+def admin_list_teachers(admin_id = Depends(require_admin)):
     with get_db() as conn:
         cur = conn.execute("""
             SELECT id, teacher_id, last_name, first_name, patronymic, email
             FROM teachers ORDER BY last_name, first_name
         """)
-        return [dict(r) for r in cur.fetchall()]
+        return _rows_as_dicts(cur)
 
 @app.post("/api/admin/teachers")
-async def admin_add_teacher(
+def admin_add_teacher(
     teacher_id: str = Form(...),
     last_name: str = Form(...),
     first_name: str = Form(...),
@@ -1403,7 +1526,7 @@ async def admin_add_teacher(
     return {"ok": True, "temp_password": temp_password}
 
 @app.put("/api/admin/teachers/{teacher_db_id}")
-async def admin_edit_teacher(
+def admin_edit_teacher(
     teacher_db_id: int,
     last_name: str = Form(...),
     first_name: str = Form(...),
@@ -1421,10 +1544,11 @@ async def admin_edit_teacher(
             WHERE id=%s
         """, (last_name, first_name, patronymic or None, email or None, teacher_db_id))
         write_audit(conn, "Изменён преподаватель", "teacher", f"{last_name} {first_name} ({row['teacher_id']})")
+    _bump_teachers_agg_version()
     return {"ok": True}
 
 @app.post("/api/admin/teachers/{teacher_db_id}/reset-password")
-async def admin_reset_teacher_password(teacher_db_id: int, admin_id = Depends(require_admin)):
+def admin_reset_teacher_password(teacher_db_id: int, admin_id = Depends(require_admin)):
     with get_db() as conn:
         cur = conn.execute("SELECT teacher_id, last_name, first_name FROM teachers WHERE id = %s", (teacher_db_id,))
         row = cur.fetchone()
@@ -1437,7 +1561,7 @@ async def admin_reset_teacher_password(teacher_db_id: int, admin_id = Depends(re
     return {"ok": True, "temp_password": temp_password}
 
 @app.delete("/api/admin/teachers/{teacher_db_id}")
-async def admin_delete_teacher(teacher_db_id: int, admin_id = Depends(require_admin)):
+def admin_delete_teacher(teacher_db_id: int, admin_id = Depends(require_admin)):
     with get_db() as conn:
         cur = conn.execute("SELECT teacher_id, last_name, first_name FROM teachers WHERE id = %s", (teacher_db_id,))
         row = cur.fetchone()
@@ -1445,12 +1569,13 @@ async def admin_delete_teacher(teacher_db_id: int, admin_id = Depends(require_ad
             raise HTTPException(404, "Преподаватель не найден")
         write_audit(conn, "Удалён преподаватель", "teacher", f"{row['last_name']} {row['first_name']} ({row['teacher_id']})")
         conn.execute("DELETE FROM teachers WHERE id = %s", (teacher_db_id,))
+    _bump_teachers_agg_version()
     return {"ok": True}
 
 # --- Предметы ---
 
 @app.get("/api/admin/subjects")
-async def admin_list_subjects(admin_id = Depends(require_admin)):
+def admin_list_subjects(admin_id = Depends(require_admin)):
     with get_db() as conn:
         cur = conn.execute("""
             SELECT s.id, s.name, s.code, s.semester,
@@ -1460,10 +1585,10 @@ async def admin_list_subjects(admin_id = Depends(require_admin)):
             LEFT JOIN teachers t ON t.id = st.teacher_id
             GROUP BY s.id ORDER BY s.name
         """)
-        return [dict(r) for r in cur.fetchall()]
+        return _rows_as_dicts(cur)
 
 @app.post("/api/admin/subjects")
-async def admin_add_subject(
+def admin_add_subject(
     name: str = Form(...),
     code: str = Form(None),
     semester: str = Form(None),
@@ -1481,7 +1606,7 @@ async def admin_add_subject(
         return {"ok": True, "id": new_id}
 
 @app.delete("/api/admin/subjects/{subject_id}")
-async def admin_delete_subject(subject_id: int, admin_id = Depends(require_admin)):
+def admin_delete_subject(subject_id: int, admin_id = Depends(require_admin)):
     with get_db() as conn:
         cur = conn.execute("SELECT name FROM subjects WHERE id = %s", (subject_id,))
         row = cur.fetchone()
@@ -1492,7 +1617,7 @@ async def admin_delete_subject(subject_id: int, admin_id = Depends(require_admin
     return {"ok": True}
 
 @app.post("/api/admin/subjects/{subject_id}/teachers")
-async def admin_assign_teacher(
+def admin_assign_teacher(
     subject_id: int,
     teacher_id: int = Form(...),
     admin_id = Depends(require_admin)
@@ -1507,10 +1632,11 @@ async def admin_assign_teacher(
         if s and t:
             write_audit(conn, "Назначен преподаватель на предмет", "subject",
                         s["name"], f"Преподаватель: {t['last_name']} {t['first_name']}")
+    _bump_teachers_agg_version()
     return {"ok": True}
 
 @app.delete("/api/admin/subjects/{subject_id}/teachers/{teacher_id}")
-async def admin_remove_teacher(subject_id: int, teacher_id: int, admin_id = Depends(require_admin)):
+def admin_remove_teacher(subject_id: int, teacher_id: int, admin_id = Depends(require_admin)):
     with get_db() as conn:
         s = conn.execute("SELECT name FROM subjects WHERE id=%s", (subject_id,)).fetchone()
         t = conn.execute("SELECT last_name, first_name FROM teachers WHERE id=%s", (teacher_id,)).fetchone()
@@ -1519,10 +1645,11 @@ async def admin_remove_teacher(subject_id: int, teacher_id: int, admin_id = Depe
         if s and t:
             write_audit(conn, "Снят преподаватель с предмета", "subject",
                         s["name"], f"Преподаватель: {t['last_name']} {t['first_name']}")
+    _bump_teachers_agg_version()
     return {"ok": True}
 
 @app.post("/api/admin/subjects/{subject_id}/students")
-async def admin_enroll_student(
+def admin_enroll_student(
     subject_id: int,
     student_id: int = Form(...),
     admin_id = Depends(require_admin)
@@ -1537,12 +1664,15 @@ async def admin_enroll_student(
         if s and st:
             write_audit(conn, "Студент зачислен на предмет", "subject",
                         s["name"], f"Студент: {st['last_name']} {st['first_name']} ({st['student_id']})")
+    _bump_teachers_agg_version()
     return {"ok": True}
 
 @app.post("/api/admin/subjects/{subject_id}/students/bulk")
-async def admin_bulk_enroll_students(subject_id: int, request: Request, admin_id = Depends(require_admin)):
-    body = await request.json()
-    student_ids = body.get("student_ids", [])
+def admin_bulk_enroll_students(
+    subject_id: int,
+    student_ids: list[int] = Body([], embed=True),
+    admin_id = Depends(require_admin)
+):
     if not student_ids:
         raise HTTPException(400, "Список студентов пуст")
     with get_db() as conn:
@@ -1555,10 +1685,11 @@ async def admin_bulk_enroll_students(subject_id: int, request: Request, admin_id
         if s:
             write_audit(conn, "Массовое зачисление на предмет", "subject",
                         s["name"], f"Зачислено студентов: {len(student_ids)}")
+    _bump_teachers_agg_version()
     return {"ok": True, "enrolled": len(student_ids)}
 
 @app.delete("/api/admin/subjects/{subject_id}/students/{student_id}")
-async def admin_unenroll_student(subject_id: int, student_id: int, admin_id = Depends(require_admin)):
+def admin_unenroll_student(subject_id: int, student_id: int, admin_id = Depends(require_admin)):
     with get_db() as conn:
         s = conn.execute("SELECT name FROM subjects WHERE id=%s", (subject_id,)).fetchone()
         st = conn.execute("SELECT last_name, first_name, student_id FROM students WHERE id=%s", (student_id,)).fetchone()
@@ -1567,10 +1698,11 @@ async def admin_unenroll_student(subject_id: int, student_id: int, admin_id = De
         if s and st:
             write_audit(conn, "Студент отчислен с предмета", "subject",
                         s["name"], f"Студент: {st['last_name']} {st['first_name']} ({st['student_id']})")
+    _bump_teachers_agg_version()
     return {"ok": True}
 
 @app.get("/api/admin/subjects/{subject_id}/members")
-async def admin_subject_members(subject_id: int, admin_id = Depends(require_admin)):
+def admin_subject_members(subject_id: int, admin_id = Depends(require_admin)):
     with get_db() as conn:
         t_cur = conn.execute("""
             SELECT t.id, t.teacher_id, t.last_name || ' ' || t.first_name AS name
@@ -1582,13 +1714,13 @@ async def admin_subject_members(subject_id: int, admin_id = Depends(require_admi
             FROM student_subjects ss JOIN students s ON s.id = ss.student_id
             WHERE ss.subject_id = %s
         """, (subject_id,))
-        return {"teachers": [dict(r) for r in t_cur.fetchall()],
-                "students": [dict(r) for r in s_cur.fetchall()]}
+        return {"teachers": _rows_as_dicts(t_cur),
+                "students": _rows_as_dicts(s_cur)}
 
 # --- Задания ---
 
 @app.get("/api/admin/assignments")
-async def admin_list_assignments(admin_id = Depends(require_admin)):
+def admin_list_assignments(admin_id = Depends(require_admin)):
     with get_db() as conn:
         cur = conn.execute("""
             SELECT a.id, a.subject_id, a.title, a.description, a.deadline,
@@ -1596,15 +1728,13 @@ async def admin_list_assignments(admin_id = Depends(require_admin)):
             FROM assignments a JOIN subjects s ON s.id = a.subject_id
             ORDER BY a.deadline DESC NULLS LAST
         """)
-        rows = []
-        for r in cur.fetchall():
-            d = dict(r)
-            d["deadline"] = d["deadline"].strftime("%Y-%m-%d") if d["deadline"] else None
-            rows.append(d)
-        return rows
+        return [
+            {**dict(r), "deadline": r["deadline"].strftime("%Y-%m-%d") if r["deadline"] else None}
+            for r in cur.fetchall()
+        ]
 
 @app.post("/api/admin/assignments")
-async def admin_add_assignment(
+def admin_add_assignment(
     subject_id: int = Form(...),
     title: str = Form(...),
     description: str = Form(None),
@@ -1626,7 +1756,7 @@ async def admin_add_assignment(
         return {"ok": True, "id": new_id}
 
 @app.put("/api/admin/assignments/{assignment_id}")
-async def admin_edit_assignment(
+def admin_edit_assignment(
     assignment_id: int,
     subject_id: int = Form(...),
     title: str = Form(...),
@@ -1651,7 +1781,7 @@ async def admin_edit_assignment(
     return {"ok": True}
 
 @app.delete("/api/admin/assignments/{assignment_id}")
-async def admin_delete_assignment(assignment_id: int, admin_id = Depends(require_admin)):
+def admin_delete_assignment(assignment_id: int, admin_id = Depends(require_admin)):
     with get_db() as conn:
         cur = conn.execute("""
             SELECT a.title, s.name AS subject_name FROM assignments a
@@ -1669,7 +1799,7 @@ async def admin_delete_assignment(assignment_id: int, admin_id = Depends(require
 # ===== ПРОГРЕСС СТУДЕНТОВ =====
 
 @app.get("/api/teacher/progress")
-async def get_teacher_progress(subject_id: Optional[int] = None, session = Depends(require_auth)):
+def get_teacher_progress(subject_id: Optional[int] = None, session = Depends(require_auth)):
     user_id, user_type = session
     if user_type != "teacher":
         raise HTTPException(403, "Доступ запрещён")
@@ -1682,7 +1812,7 @@ async def get_teacher_progress(subject_id: Optional[int] = None, session = Depen
             WHERE st_link.teacher_id = %s
             ORDER BY subj.name
         """, (user_id,))
-        subjects = [dict(r) for r in cur.fetchall()]
+        subjects = _rows_as_dicts(cur)
 
         query = """
             SELECT
@@ -1710,21 +1840,26 @@ async def get_teacher_progress(subject_id: Optional[int] = None, session = Depen
         query += " ORDER BY subj.name, st.last_name, a.deadline"
 
         cur = conn.execute(query, params)
-        rows = []
-        for r in cur.fetchall():
-            d = dict(r)
-            d["deadline"] = d["deadline"].isoformat() if d["deadline"] else None
-            d["submitted_at"] = d["submitted_at"].isoformat() if d["submitted_at"] else None
-            rows.append(d)
+        rows = [
+            {**dict(r),
+             "deadline": r["deadline"].isoformat() if r["deadline"] else None,
+             "submitted_at": r["submitted_at"].isoformat() if r["submitted_at"] else None}
+            for r in cur.fetchall()
+        ]
 
         return {"subjects": subjects, "rows": rows}
 
 
 # ===== СКАЧИВАНИЕ ФАЙЛОВ =====
 
+# Ключи R2 — не файловые пути (symlink/realpath неприменимы): вместо проверки
+# на ".." достаточно ограничить ключ известными префиксами хранилища.
+# Заодно перестаём ложно отклонять легальные имена вида "my..file.txt".
+_ALLOWED_KEY_PREFIXES = ("submissions/", "feedback/")
+
 @app.get("/download/{path:path}")
-async def download_file(path: str, session = Depends(require_auth)):
-    if ".." in path or path.startswith("/"):
+def download_file(path: str, session = Depends(require_auth)):
+    if not path.startswith(_ALLOWED_KEY_PREFIXES):
         raise HTTPException(400, "Некорректный путь")
 
     user_id, user_type = session
@@ -1764,7 +1899,7 @@ async def download_file(path: str, session = Depends(require_auth)):
 # ===== ОБЪЯВЛЕНИЯ (БАННЕР) =====
 
 @app.get("/api/announcements/active")
-async def get_active_announcement(session = Depends(require_auth)):
+def get_active_announcement(session = Depends(require_auth)):
     with get_db() as conn:
         cur = conn.execute("""
             SELECT id, title, body, expires_at, created_at
@@ -1786,7 +1921,7 @@ async def get_active_announcement(session = Depends(require_auth)):
     }
 
 @app.get("/api/admin/announcements")
-async def admin_list_announcements(admin_id = Depends(require_admin)):
+def admin_list_announcements(admin_id = Depends(require_admin)):
     with get_db() as conn:
         cur = conn.execute("""
             SELECT id, title, body, is_active, expires_at, created_at
@@ -1805,7 +1940,7 @@ async def admin_list_announcements(admin_id = Depends(require_admin)):
     ]
 
 @app.post("/api/admin/announcements")
-async def admin_create_announcement(
+def admin_create_announcement(
     title: str = Form(...),
     body: str = Form(...),
     expires_at: Optional[str] = Form(None),
@@ -1827,7 +1962,7 @@ async def admin_create_announcement(
     return {"id": new_id, "message": "Объявление создано"}
 
 @app.delete("/api/admin/announcements/{ann_id}")
-async def admin_delete_announcement(ann_id: int, admin_id = Depends(require_admin)):
+def admin_delete_announcement(ann_id: int, admin_id = Depends(require_admin)):
     with get_db() as conn:
         row = conn.execute("SELECT title FROM announcements WHERE id=%s", (ann_id,)).fetchone()
         if row:
@@ -1839,7 +1974,7 @@ async def admin_delete_announcement(ann_id: int, admin_id = Depends(require_admi
 # ===== ЛИЧНЫЕ СООБЩЕНИЯ =====
 
 @app.get("/api/messages/me")
-async def get_my_messages(session = Depends(require_auth)):
+def get_my_messages(session = Depends(require_auth)):
     user_id, user_type = session
     if user_type != "student":
         raise HTTPException(403, "Доступ запрещён")
@@ -1862,7 +1997,7 @@ async def get_my_messages(session = Depends(require_auth)):
     ]
 
 @app.get("/api/messages/me/unread-count")
-async def get_unread_count(session = Depends(require_auth)):
+def get_unread_count(session = Depends(require_auth)):
     user_id, user_type = session
     if user_type != "student":
         raise HTTPException(403, "Доступ запрещён")
@@ -1875,7 +2010,7 @@ async def get_unread_count(session = Depends(require_auth)):
     return {"count": count}
 
 @app.put("/api/messages/{msg_id}/read")
-async def mark_message_read(msg_id: int, session = Depends(require_auth)):
+def mark_message_read(msg_id: int, session = Depends(require_auth)):
     user_id, user_type = session
     if user_type != "student":
         raise HTTPException(403, "Доступ запрещён")
@@ -1887,7 +2022,7 @@ async def mark_message_read(msg_id: int, session = Depends(require_auth)):
     return {"message": "Прочитано"}
 
 @app.post("/api/messages/send")
-async def send_personal_message(
+def send_personal_message(
     student_id: int = Form(...),
     title: str = Form(...),
     body: str = Form(...),
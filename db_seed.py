@@ -6,6 +6,7 @@ import os
 from contextlib import closing
 from pathlib import Path
 import psycopg2
+from psycopg2.extras import execute_values
 import bcrypt as _bcrypt
 
 
@@ -16,6 +17,18 @@ def hash_password(password: str) -> str:
 BASE_DIR = Path(__file__).resolve().parent
 SCHEMA_PATH = BASE_DIR / "schema.sql"
 
+# Текст schema.sql читается один раз при первом обращении
+_schema_sql: str | None = None
+
+
+def _load_schema_sql() -> str:
+    global _schema_sql
+    if _schema_sql is None:
+        if not SCHEMA_PATH.exists():
+            raise FileNotFoundError(f"Файл схемы не найден: {SCHEMA_PATH}")
+        _schema_sql = SCHEMA_PATH.read_text(encoding="utf-8")
+    return _schema_sql
+
 
 def _get_database_url() -> str:
     url = os.environ.get("DATABASE_URL", "")
@@ -30,25 +43,37 @@ def get_connection():
     return psycopg2.connect(_get_database_url())
 
 
-def init_db():
-    """Создаёт таблицы из schema.sql"""
-    if not SCHEMA_PATH.exists():
-        raise FileNotFoundError(f"Файл схемы не найден: {SCHEMA_PATH}")
+def init_db(conn=None):
+    """Создаёт таблицы из schema.sql.
 
-    with closing(get_connection()) as conn:
-        with conn:
-            with conn.cursor() as cur:
-                with open(SCHEMA_PATH, "r", encoding="utf-8") as f:
-                    cur.execute(f.read())
+    Если соединение передано, использует его (схема применяется в отдельной
+    транзакции); иначе открывает и закрывает собственное.
+    """
+    schema_sql = _load_schema_sql()
+
+    if conn is None:
+        with closing(get_connection()) as own_conn:
+            init_db(own_conn)
+        return
+
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(schema_sql)
 
 
 def seed_data():
     """Создаёт БД и наполняет тестовыми данными"""
-    init_db()
-
     with closing(get_connection()) as conn:
+        # Схема и данные — на одном соединении, без повторного подключения
+        init_db(conn)
         with conn:
             with conn.cursor() as cur:
+                # Повторный запуск: данные уже есть — все вставки можно пропустить
+                cur.execute("SELECT 1 FROM students LIMIT 1")
+                if cur.fetchone() is not None:
+                    print("ℹ️ БД уже содержит данные — сидирование пропущено.")
+                    return
+
                 # === Студенты ===
                 students_raw = [
                     ("2023-IS-042", "Иванов", "Иван", "Иванович", "ivanov@example.com", "ИС-31", "2001-05-15", "15052001"),
@@ -59,10 +84,12 @@ def seed_data():
                     (sid, ln, fn, pat, email, grp, bd, hash_password(pwd))
                     for sid, ln, fn, pat, email, grp, bd, pwd in students_raw
                 ]
-                cur.executemany("""
+                # execute_values разворачивает пачку в один multi-row INSERT
+                # вместо отдельного запроса на каждую строку
+                execute_values(cur, """
                     INSERT INTO students
                     (student_id, last_name, first_name, patronymic, email, group_name, birth_date, password_hash)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    VALUES %s
                     ON CONFLICT DO NOTHING
                 """, students)
 
@@ -75,10 +102,10 @@ def seed_data():
                     (tid, ln, fn, pat, email, bd, hash_password(pwd))
                     for tid, ln, fn, pat, email, bd, pwd in teachers_raw
                 ]
-                cur.executemany("""
+                execute_values(cur, """
                     INSERT INTO teachers
                     (teacher_id, last_name, first_name, patronymic, email, birth_date, password_hash)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    VALUES %s
                     ON CONFLICT DO NOTHING
                 """, teachers)
 
@@ -88,15 +115,16 @@ def seed_data():
                     ("Программирование на Python", "CS102", "2025-1"),
                     ("Экономика", "ECON101", "2025-1"),
                 ]
-                cur.executemany("""
+                execute_values(cur, """
                     INSERT INTO subjects (name, code, semester)
-                    VALUES (%s, %s, %s)
+                    VALUES %s
                     ON CONFLICT DO NOTHING
                 """, subjects)
 
-                # Получаем ID после вставки
-                cur.execute("SELECT id, name FROM subjects")
-                subject_map = {name: sid for sid, name in cur.fetchall()}
+                # Получаем ID после вставки; ключ — код предмета: он короткий,
+                # стабильный и не сломается при переименовании предмета
+                cur.execute("SELECT code, id FROM subjects")
+                subject_map = dict(cur.fetchall())
 
                 cur.execute("SELECT id, teacher_id FROM teachers")
                 teacher_map = {tid: pk for pk, tid in cur.fetchall()}
@@ -106,38 +134,38 @@ def seed_data():
 
                 # === Связь: студенты → предметы ===
                 student_subject_links = [
-                    (student_map["2023-IS-042"], subject_map["Математика"]),
-                    (student_map["2023-IS-042"], subject_map["Программирование на Python"]),
-                    (student_map["2023-IS-043"], subject_map["Математика"]),
-                    (student_map["2023-ЭК-115"], subject_map["Экономика"]),
+                    (student_map["2023-IS-042"], subject_map["MATH101"]),
+                    (student_map["2023-IS-042"], subject_map["CS102"]),
+                    (student_map["2023-IS-043"], subject_map["MATH101"]),
+                    (student_map["2023-ЭК-115"], subject_map["ECON101"]),
                 ]
-                cur.executemany("""
+                execute_values(cur, """
                     INSERT INTO student_subjects (student_id, subject_id)
-                    VALUES (%s, %s)
+                    VALUES %s
                     ON CONFLICT DO NOTHING
                 """, student_subject_links)
 
                 # === Задания ===
                 assignments = [
-                    (subject_map["Математика"], "Контрольная работа №1", "Решить 10 задач", "2026-02-01"),
-                    (subject_map["Программирование на Python"], "Лабораторная №1", "Написать программу", "2026-02-15"),
-                    (subject_map["Экономика"], "Эссе", "Проанализировать рынок", "2026-03-01"),
+                    (subject_map["MATH101"], "Контрольная работа №1", "Решить 10 задач", "2026-02-01"),
+                    (subject_map["CS102"], "Лабораторная №1", "Написать программу", "2026-02-15"),
+                    (subject_map["ECON101"], "Эссе", "Проанализировать рынок", "2026-03-01"),
                 ]
-                cur.executemany("""
+                execute_values(cur, """
                     INSERT INTO assignments (subject_id, title, description, deadline)
-                    VALUES (%s, %s, %s, %s)
+                    VALUES %s
                     ON CONFLICT DO NOTHING
                 """, assignments)
 
                 # === Связь: преподаватели → предметы ===
                 subject_teacher_links = [
-                    (subject_map["Математика"], teacher_map["T-MATH-01"]),
-                    (subject_map["Программирование на Python"], teacher_map["T-CS-02"]),
-                    (subject_map["Экономика"], teacher_map["T-MATH-01"]),
+                    (subject_map["MATH101"], teacher_map["T-MATH-01"]),
+                    (subject_map["CS102"], teacher_map["T-CS-02"]),
+                    (subject_map["ECON101"], teacher_map["T-MATH-01"]),
                 ]
-                cur.executemany("""
+                execute_values(cur, """
                     INSERT INTO subject_teachers (subject_id, teacher_id)
-                    VALUES (%s, %s)
+                    VALUES %s
                     ON CONFLICT DO NOTHING
                 """, subject_teacher_links)
 
@@ -170,6 +170,23 @@ CREATE TABLE IF NOT EXISTS personal_messages (
     created_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Индексы для горячих join/фильтров (уникальные индексы на students.student_id,
+-- teachers.teacher_id и subjects.name уже создаются ограничениями UNIQUE)
+CREATE INDEX IF NOT EXISTS idx_assignments_subject        ON assignments(subject_id);
+CREATE INDEX IF NOT EXISTS idx_submissions_assignment     ON submissions(assignment_id);
+CREATE INDEX IF NOT EXISTS idx_submission_files_sub       ON submission_files(submission_id);
+CREATE INDEX IF NOT EXISTS idx_feedback_files_sub         ON teacher_feedback_files(submission_id);
+CREATE INDEX IF NOT EXISTS idx_grades_subject             ON grades(subject_id);
+-- составной (teacher_id, subject_id): покрывает выборки "предметы преподавателя",
+-- обратный порядок к PK (subject_id, teacher_id); одиночный индекс больше не нужен
+DROP INDEX IF EXISTS idx_subject_teachers_teacher;
+CREATE INDEX IF NOT EXISTS idx_subject_teachers_teacher_subject
+    ON subject_teachers(teacher_id, subject_id);
+CREATE INDEX IF NOT EXISTS idx_student_subjects_subject   ON student_subjects(subject_id);
+CREATE INDEX IF NOT EXISTS idx_sessions_user              ON sessions(user_id, user_type);
+CREATE INDEX IF NOT EXISTS idx_sessions_expires           ON sessions(expires_at);
+CREATE INDEX IF NOT EXISTS idx_personal_messages_student  ON personal_messages(student_id);
+
 CREATE TABLE IF NOT EXISTS admin_audit_log (
     id          SERIAL PRIMARY KEY,
     action      TEXT NOT NULL,